@@ -1,16 +1,25 @@
 from dataclasses import dataclass
 from tqdm import tqdm
-from typing import Optional
+from typing import NamedTuple
+import math
 import os
 
 os.environ["PYGAME_HIDE_SUPPORT_PROMPT"] = "hide"
 import pygame as pg
 from pathlib import Path
+import numpy as np
+from numba import njit
+
+# Float type for simulation state. Positions only need to be accurate to a pixel so
+# single precision is plenty, and it halves memory traffic in the kernels.
+DTYPE = np.float32
+
 
 @dataclass
 class Settings:
     duration_seconds: float
-    timestep: float
+    timestep: float = 0.02  # s, upper bound on the integrator step
+    snapshot_rate: float = 60  # Hz
 
 
 @dataclass
@@ -30,9 +39,6 @@ class Mass:
     fx: float  # N, represents horizontal
     fy: float  # N
 
-    def snapshot(self):
-        return (self.name, self.x, self.y)
-
 
 @dataclass
 class Anchor:
@@ -57,39 +63,9 @@ class Rope:
     length: float  # m
     spring: float  # N to stretch 100%
 
-    tension: Optional[float] = None  # N
-
-    def calculate_tension(self, distance):
-        if distance <= self.length:
-            self.tension = 0
-        else:
-            self.tension = self.spring * (distance - self.length)
-
-    def calculate_forces(self):
-        # force on start
-        # note: the force on end is the negative of force on start
-        x_dist = self.start.x - self.end.x
-        y_dist = self.start.y - self.end.y
-        distance = (x_dist**2 + y_dist**2) ** 0.5
-        if distance == 0:
-            return 0, 0
-
-        self.calculate_tension(distance)
-
-        # Negative because this is a 'pull' not a 'push'
-        fx = -x_dist / distance * self.tension
-        fy = -y_dist / distance * self.tension
-        return fx, fy
-
-    def snapshot(self):
-        return (self.start.x, self.start.y, self.end.x, self.end.y, self.tension)
 
-
-def force_at_100_percent_stretch():
-    # Calculation of spring constant
-    stretch = 0.05  # 5% stretch
-    force_at_stretch = 1500  # N
-    return force_at_stretch / stretch
+# Spring constant of a rope which stretches 5% under 1500N
+SPRING_CONSTANT: float = 1500 / 0.05  # N to stretch 100%
 
 
 def fall_during_tyrolean():
@@ -106,13 +82,13 @@ def fall_during_tyrolean():
             start=masses[0],
             end=anchors[0],
             length=5.5,
-            spring=force_at_100_percent_stretch(),
+            spring=SPRING_CONSTANT,
         ),
         Rope(
             start=masses[0],
             end=anchors[1],
             length=5.5,
-            spring=force_at_100_percent_stretch(),
+            spring=SPRING_CONSTANT,
         ),
     ]
     return masses, anchors, ropes
@@ -128,78 +104,300 @@ def fall_from_anchor():
             start=masses[0],
             end=anchors[0],
             length=6,
-            spring=force_at_100_percent_stretch(),
+            spring=SPRING_CONSTANT,
         ),
     ]
     return masses, anchors, ropes
 
 
-def simulate(settings, masses, anchors, ropes) -> list:
+class World(NamedTuple):
+    # Simulation state as plain arrays, built once from the scene description.
+    # points holds every mass followed by every anchor; pos is a view of the masses
+    # so moving a mass also moves the rope endpoints attached to it.
+    # Anchors are treated as infinitely heavy points, so the kernels can apply
+    # forces to every rope endpoint without checking what it is attached to.
+    points: np.ndarray  # m, shape (masses + anchors, 2)
+    pos: np.ndarray  # m, shape (masses, 2)
+    vel: np.ndarray  # m/s, shape (masses + anchors, 2)
+    force: np.ndarray  # N, shape (masses + anchors, 2)
+    mass: np.ndarray  # kg, shape (masses + anchors,)
+
+
+class RopeArrays(NamedTuple):
+    # Rope endpoints are indices into World.points
+    start_idx: np.ndarray
+    end_idx: np.ndarray
+    length: np.ndarray  # m
+    spring: np.ndarray  # N to stretch 100%
+
+
+def build_soa(masses, anchors, ropes) -> tuple[World, RopeArrays]:
+    index = {id(mass): i for i, mass in enumerate(masses)}
+    index.update({id(anchor): len(masses) + i for i, anchor in enumerate(anchors)})
+
+    points = np.array(
+        [(point.x, point.y) for point in [*masses, *anchors]], dtype=DTYPE
+    ).reshape(-1, 2)
+    velocities = np.zeros_like(points)
+    velocities[: len(masses)] = np.array(
+        [(mass.vx, mass.vy) for mass in masses], dtype=DTYPE
+    ).reshape(-1, 2)
+    world = World(
+        points=points,
+        pos=points[: len(masses)],
+        vel=velocities,
+        force=np.zeros_like(points),
+        mass=np.array(
+            [mass.mass for mass in masses] + [np.inf] * len(anchors), dtype=DTYPE
+        ),
+    )
+
+    rope_arrays = RopeArrays(
+        start_idx=np.array([index[id(rope.start)] for rope in ropes], dtype=np.intp),
+        end_idx=np.array([index[id(rope.end)] for rope in ropes], dtype=np.intp),
+        length=np.array([rope.length for rope in ropes], dtype=DTYPE),
+        spring=np.array([rope.spring for rope in ropes], dtype=DTYPE),
+    )
+    return world, rope_arrays
+
+
+@njit(cache=True, fastmath=True)
+def adaptive_timestep(
+    points, start_idx, end_idx, length, spring, rope_inv_mass, min_omega, max_timestep
+):
+    # Velocity Verlet is stable for dt < T / (sqrt(2) * pi) where T = 2 * pi / omega
+    # is the period of the stiffest rope/ mass pair, i.e. dt < sqrt(2) / omega.
+    # Slack ropes apply no force so only ropes currently in tension count, and
+    # min_omega stops the step growing without bound while everything is falling.
+    omega_max = min_omega
+    for r in range(start_idx.shape[0]):
+        x_dist = points[start_idx[r], 0] - points[end_idx[r], 0]
+        y_dist = points[start_idx[r], 1] - points[end_idx[r], 1]
+        if x_dist * x_dist + y_dist * y_dist > length[r] * length[r]:
+            omega_max = max(omega_max, math.sqrt(spring[r] * rope_inv_mass[r]))
+    if omega_max == 0:
+        return max_timestep
+    # Halve the limit to leave some margin when a rope snaps taut mid step
+    timestep = min(max_timestep, 0.5 * 2**0.5 / omega_max)
+    # Never hand back a step which would stop advance() making progress
+    return timestep if timestep > 0 else max_timestep
+
+
+@njit(cache=True, fastmath=True)
+def apply_rope_forces(
+    points,
+    vel,
+    force,
+    inv_mass,
+    start_idx,
+    end_idx,
+    length,
+    spring,
+    tension,
+    damping,
+    timestep,
+):
+    # Add the force from each rope, the force on end is the negative of force on start
+    for r in range(start_idx.shape[0]):
+        start = start_idx[r]
+        end = end_idx[r]
+        x_dist = points[start, 0] - points[end, 0]
+        y_dist = points[start, 1] - points[end, 1]
+        distance = math.sqrt(x_dist * x_dist + y_dist * y_dist)
+
+        # Slack ropes have zero tension and zero length ropes have no direction
+        tension[r] = spring[r] * max(distance - length[r], 0.0)
+        # Negative because this is a 'pull' not a 'push'
+        scale = -tension[r] / distance if distance > 0 else 0.0
+        fx = scale * x_dist
+        fy = scale * y_dist
+        # Like the rope force, damping only acts through ropes in tension
+        rope_damping = damping * timestep if tension[r] > 0 else 0.0
+
+        force[start, 0] += fx - rope_damping * vel[start, 0] * inv_mass[start]
+        force[start, 1] += fy - rope_damping * vel[start, 1] * inv_mass[start]
+        force[end, 0] -= fx + rope_damping * vel[end, 0] * inv_mass[end]
+        force[end, 1] -= fy + rope_damping * vel[end, 1] * inv_mass[end]
+
+
+@njit(cache=True, fastmath=True)
+def step(
+    points,
+    vel,
+    force,
+    acceleration,
+    inv_mass,
+    start_idx,
+    end_idx,
+    length,
+    spring,
+    tension,
+    gravity_force,
+    damping,
+    timestep,
+):
+    # Velocity Verlet, using half step velocities so only one acceleration array is
+    # needed between steps. Forces are reset to gravity in the same pass as the
+    # position update since they don't depend on each other.
+    half_timestep = 0.5 * timestep
+    for i in range(inv_mass.shape[0]):
+        for axis in range(2):
+            vel[i, axis] += acceleration[i, axis] * half_timestep
+            points[i, axis] += vel[i, axis] * timestep
+            force[i, axis] = gravity_force[i, axis]
+
+    apply_rope_forces(
+        points,
+        vel,
+        force,
+        inv_mass,
+        start_idx,
+        end_idx,
+        length,
+        spring,
+        tension,
+        damping,
+        timestep,
+    )
+
+    for i in range(inv_mass.shape[0]):
+        for axis in range(2):
+            acceleration[i, axis] = force[i, axis] * inv_mass[i]
+            vel[i, axis] += acceleration[i, axis] * half_timestep
+
+
+@njit(cache=True, fastmath=True)
+def advance(
+    points,
+    vel,
+    force,
+    acceleration,
+    inv_mass,
+    start_idx,
+    end_idx,
+    length,
+    spring,
+    tension,
+    rope_inv_mass,
+    gravity_force,
+    damping,
+    min_omega,
+    max_timestep,
+    duration,
+):
+    # Split the duration into steps no larger than the current stable timestep,
+    # re-evaluated every step as ropes go taut and slack.
+    remaining = duration
+    while remaining > 0:
+        stable = adaptive_timestep(
+            points,
+            start_idx,
+            end_idx,
+            length,
+            spring,
+            rope_inv_mass,
+            min_omega,
+            max_timestep,
+        )
+        timestep = remaining / np.ceil(remaining / stable)
+        remaining -= timestep
+        step(
+            points,
+            vel,
+            force,
+            acceleration,
+            inv_mass,
+            start_idx,
+            end_idx,
+            length,
+            spring,
+            tension,
+            gravity_force,
+            damping,
+            timestep,
+        )
+
+
+def simulate(settings, masses, anchors, ropes) -> tuple[np.ndarray, np.ndarray]:
     GRAVITY = 9.8
 
     # TODO figure out appropriate damping
     DAMPING_CONSTANT = 2000000
     DAMPING_ENABLED = False
-
-    snapshots = []
-    for i in tqdm(range(1, int(settings.duration_seconds / settings.timestep) + 1)):
-        current_time = i * settings.timestep
-        # Reset forces
-        for mass in masses:
-            mass.fx = 0.0
-            mass.fy = -GRAVITY * mass.mass
-
-        # Apply force from ropes
-        for rope in ropes:
-            fx, fy = rope.calculate_forces()
-
-            if fx > 0 or fy > 0:
-                if isinstance(rope.start, Mass):
-                    rope.start.fx += fx
-                    rope.start.fy += fy
-                    if DAMPING_ENABLED:
-                        rope.start.fx -= (
-                            DAMPING_CONSTANT * rope.start.vx / rope.start.mass
-                        ) * settings.timestep
-                        rope.start.fy -= (
-                            DAMPING_CONSTANT * rope.start.vy / rope.start.mass
-                        ) * settings.timestep
-
-                if isinstance(rope.end, Mass):
-                    rope.end.fx -= fx
-                    rope.end.fy -= fy
-                    if DAMPING_ENABLED:
-                        rope.end.fx -= (
-                            DAMPING_CONSTANT * rope.end.vx / rope.end.mass
-                        ) * settings.timestep
-                        rope.end.fy -= (
-                            DAMPING_CONSTANT * rope.end.vy / rope.end.mass
-                        ) * settings.timestep
-
-        # Apply accelerations to adjust velocities
-        for mass in masses:
-            mass.vx += (mass.fx / mass.mass) * settings.timestep
-            mass.vy += (mass.fy / mass.mass) * settings.timestep
-
-        # Update positions
-        for mass in masses:
-            mass.x += settings.timestep * mass.vx
-            mass.y += settings.timestep * mass.vy
+    damping = DAMPING_CONSTANT if DAMPING_ENABLED else 0.0
+
+    world, rope_arrays = build_soa(masses, anchors, ropes)
+    points, pos, vel, force, mass = world
+    start_idx, end_idx, length, spring = rope_arrays
+
+    # Anchors have zero inverse mass so are never moved or accelerated by gravity
+    inv_mass = 1 / mass
+    gravity_force = np.zeros_like(force)
+    gravity_force[:, 1] = np.where(inv_mass > 0, -GRAVITY * mass, 0)
+    # Inverse of the lightest mass on each rope, for the rope's natural frequency
+    rope_inv_mass = np.maximum(inv_mass[start_idx], inv_mass[end_idx])
+    # Natural frequency of a pendulum on the shortest rope, this bounds the timestep
+    # while no ropes are in tension. Zero length ropes can't swing so are skipped.
+    swing_lengths = length[length > 0]
+    min_omega = (GRAVITY / swing_lengths.min()) ** 0.5 if len(swing_lengths) else 0.0
+    snapshot_interval = 1 / settings.snapshot_rate
+
+    tension = np.zeros(len(ropes), dtype=DTYPE)
+    force[:] = gravity_force
+    apply_rope_forces(
+        points,
+        vel,
+        force,
+        inv_mass,
+        start_idx,
+        end_idx,
+        length,
+        spring,
+        tension,
+        damping,
+        settings.timestep,
+    )
+    acceleration = force * inv_mass[:, None]
+
+    # Snapshots are written straight into preallocated arrays, one row per frame
+    snapshot_count = int(settings.duration_seconds * settings.snapshot_rate)
+    mass_snapshots = np.empty((snapshot_count, len(masses), 2), dtype=DTYPE)
+    rope_snapshots = np.empty((snapshot_count, len(ropes), 5), dtype=DTYPE)
+
+    # One compiled call per snapshot, so tqdm only updates once per frame
+    for frame in tqdm(range(snapshot_count)):
+        advance(
+            points,
+            vel,
+            force,
+            acceleration,
+            inv_mass,
+            start_idx,
+            end_idx,
+            length,
+            spring,
+            tension,
+            rope_inv_mass,
+            gravity_force,
+            damping,
+            min_omega,
+            settings.timestep,
+            snapshot_interval,
+        )
 
         # Save a snapshot for rendering later
-        snapshots.append(
-            [
-                [mass.snapshot() for mass in masses],
-                [rope.snapshot() for rope in ropes],
-            ]
-        )
+        mass_snapshots[frame] = pos
+        rope_snapshots[frame, :, 0:2] = points[start_idx]
+        rope_snapshots[frame, :, 2:4] = points[end_idx]
+        rope_snapshots[frame, :, 4] = tension
 
-    return snapshots
+    return mass_snapshots, rope_snapshots
 
 
 def render(simulation_settings, masses, anchors, ropes, snapshots, save=False):
     FPS = 60
     SIMULATION_SPEED = 1
+    mass_snapshots, rope_snapshots = snapshots
 
     # Load pygame fullscreen
     pg.init()
@@ -212,20 +410,21 @@ def render(simulation_settings, masses, anchors, ropes, snapshots, save=False):
     max_x = 20
     max_y = height / width * max_x
 
-    def draw_circle(surface, x, y, radius, colour, outline=None):
-        center = (width * x / max_x, height * (1 - y / max_y))
+    # Kept in the snapshot dtype so converting the snapshots doesn't upcast them
+    screen_scale = np.array((width / max_x, -height / max_y), dtype=DTYPE)
+    screen_offset = np.array((0, height), dtype=DTYPE)
+
+    def to_screen(positions):
+        # Convert an array of (..., 2) simulation positions to pixel positions
+        return positions * screen_scale + screen_offset
+
+    def draw_circle(surface, center, radius, colour, outline=None):
         if outline:
             pg.draw.circle(surface, (0, 0, 0), center, radius + outline)
         pg.draw.circle(surface, colour, center, radius)
 
-    def draw_line(surface, x1, y1, x2, y2, colour, thickness=4):
-        pg.draw.line(
-            surface,
-            colour,
-            (width * x1 / max_x, height * (1 - y1 / max_y)),
-            (width * x2 / max_x, height * (1 - y2 / max_y)),
-            thickness,
-        )
+    def draw_line(surface, start, end, colour, thickness=4):
+        pg.draw.line(surface, colour, start, end, thickness)
 
     def rope_colour_scale(tension):
         nothing = (0, 255, 0)
@@ -233,7 +432,7 @@ def render(simulation_settings, masses, anchors, ropes, snapshots, save=False):
         mid = (255, 153, 102)
         end = (128, 0, 0)
 
-        if tension == 0 or tension is None:
+        if tension == 0:
             return nothing
         elif tension <= 5000:
             ratio = tension / 5000
@@ -244,11 +443,35 @@ def render(simulation_settings, masses, anchors, ropes, snapshots, save=False):
         else:
             return end
 
+    # Lookup table of rope colours, the colour of a rope is
+    # rope_colours[ceil(tension / MAX_COLOUR_TENSION * COLOUR_STEPS)] which keeps zero
+    # tension at its own colour and clamps anything over the max to the end colour.
+    MAX_COLOUR_TENSION = 10000
+    COLOUR_STEPS = 1024
+    rope_colours = [
+        tuple(int(round(channel)) for channel in rope_colour_scale(tension))
+        for tension in np.linspace(0, MAX_COLOUR_TENSION, COLOUR_STEPS + 1)
+    ]
+
     # Create a background
     background = pg.surface.Surface((width, height))
     background.fill((100, 100, 100))
-    for anchor in anchors:
-        draw_circle(background, anchor.x, anchor.y, 20, (200, 0, 0), outline=2)
+    anchor_positions = np.array([(anchor.x, anchor.y) for anchor in anchors])
+    for center in to_screen(anchor_positions.reshape(-1, 2)).tolist():
+        draw_circle(background, center, 20, (200, 0, 0), outline=2)
+
+    # Convert every snapshot to screen coordinates up front
+    mass_centers = to_screen(mass_snapshots)
+    rope_starts = to_screen(rope_snapshots[..., 0:2])
+    rope_ends = to_screen(rope_snapshots[..., 2:4])
+    rope_colour_indices = np.minimum(
+        np.ceil(rope_snapshots[..., 4] / MAX_COLOUR_TENSION * COLOUR_STEPS),
+        COLOUR_STEPS,
+    ).astype(int)
+
+    # Transparent layers for the moving parts, cleared and redrawn every frame
+    masses_surface = pg.surface.Surface((width, height), pg.SRCALPHA, 32)
+    ropes_surface = pg.surface.Surface((width, height), pg.SRCALPHA, 32)
 
     total_frame_count = int(
         simulation_settings.duration_seconds * FPS / SIMULATION_SPEED
@@ -262,20 +485,22 @@ def render(simulation_settings, masses, anchors, ropes, snapshots, save=False):
                 pg.quit()
                 return
 
-        snapshot_index = int(i / total_frame_count * len(snapshots))
+        snapshot_index = int(i / total_frame_count * len(mass_snapshots))
 
         # Handle masses
-        masses_surface = pg.surface.Surface((width, height), pg.SRCALPHA, 32)
-        for name, x, y in snapshots[snapshot_index][0]:
-            draw_circle(masses_surface, x, y, 20, (0, 100, 0), outline=2)
+        masses_surface.fill((0, 0, 0, 0))
+        for center in mass_centers[snapshot_index].tolist():
+            draw_circle(masses_surface, center, 20, (0, 100, 0), outline=2)
 
         # Handle ropes
-        ropes_surface = pg.surface.Surface((width, height), pg.SRCALPHA, 32)
-        for rope_index, snapshot_data in enumerate(snapshots[snapshot_index][1]):
-            start_x, start_y, end_x, end_y, tension = snapshot_data
-            rope = ropes[rope_index]
-            colour = rope_colour_scale(tension)
-            draw_line(masses_surface, start_x, start_y, end_x, end_y, colour)
+        ropes_surface.fill((0, 0, 0, 0))
+        for start, end, colour_index in zip(
+            rope_starts[snapshot_index].tolist(),
+            rope_ends[snapshot_index].tolist(),
+            rope_colour_indices[snapshot_index].tolist(),
+        ):
+            colour = rope_colours[colour_index]
+            draw_line(ropes_surface, start, end, colour)
 
         screen.blit(background, (0, 0))
         screen.blit(masses_surface, (0, 0))
@@ -284,7 +509,10 @@ def render(simulation_settings, masses, anchors, ropes, snapshots, save=False):
         pg.display.update()
 
         if save:
-            pg.image.save(screen, Path(__file__).parent.joinpath("video-frames", f"frame-{i:0>4}.png"))
+            frame_path = Path(__file__).parent.joinpath(
+                "video-frames", f"frame-{i:0>4}.png"
+            )
+            pg.image.save(screen, frame_path)
     pg.quit()
 
     if save:
@@ -293,10 +521,7 @@ def render(simulation_settings, masses, anchors, ropes, snapshots, save=False):
 
 
 def main():
-    simulation_settings = Settings(
-        duration_seconds=4,
-        timestep=0.005,
-    )
+    simulation_settings = Settings(duration_seconds=4)
     masses, anchors, ropes = fall_during_tyrolean()
     # masses, anchors, ropes = fall_from_anchor()
 